@@ -10,10 +10,8 @@ from mmcv.transforms import BaseTransform
 from mmengine.utils import is_tuple_of
 
 from mmagic.registry import TRANSFORMS
-from .gcp_unprocess import (add_noise, apply_ccm, gamma_expansion,
-                            inverse_smoothstep, mosaic, random_ccm,
-                            random_gains, random_noise_levels_kpn,
-                            safe_invert_gains)
+from . import gcp_unprocess
+from .gcp_unprocess import add_noise, mosaic, random_noise_levels_kpn
 
 
 @TRANSFORMS.register_module()
@@ -25,12 +23,20 @@ class Img2LQ_Raws(BaseTransform):
     dict(type='Img2LQ_Raws', key='img', global_align=False, sensor_noise=False)
 
     dict(type='Img2LQ_Raws', key='img', global_align=True, sensor_noise=True)
+
+    Set ``use_numba=True`` to unprocess with the numba kernels, which are
+    faster but differ from the torch path by up to 2e-3.
     """
 
-    def __init__(self, key, global_align=False, sensor_noise=False):
+    def __init__(self,
+                 key,
+                 global_align=False,
+                 sensor_noise=False,
+                 use_numba=False):
         self.key = key
         self.global_align = global_align
         self.sensor_noise = sensor_noise
+        self.use_numba = use_numba
 
     def BGR2RGB(self, img_bgr):
         return img_bgr[..., ::-1]
@@ -38,28 +44,14 @@ class Img2LQ_Raws(BaseTransform):
     def unprocess_meta_gt(self, image, rgb_gains, red_gains, blue_gains,
                           rgb2cam, cam2rgb):
         """Unprocesses an image from sRGB to realistic raw data."""
-
-        # Approximately inverts global tone mapping.
-        image = inverse_smoothstep(image)
-        # Inverts gamma compression.
-        image = gamma_expansion(image)
-        # Inverts color correction.
-        image = apply_ccm(image, rgb2cam)
-        # Approximately inverts white balance and brightening.
-        image = safe_invert_gains(image, rgb_gains, red_gains, blue_gains)
-        # Clips saturated pixels.
-        image = torch.clamp(image, min=0.0, max=1.0)
-        # Applies a Bayer mosaic.
-        # image = mosaic(image)
-
-        metadata = {
-            'cam2rgb': cam2rgb,
-            'rgb2cam': rgb2cam,
-            'rgb_gain': rgb_gains,
-            'red_gain': red_gains,
-            'blue_gain': blue_gains,
-        }
-        return image, metadata
+        return gcp_unprocess.unprocess_meta_gt(
+            image,
+            rgb_gains,
+            red_gains,
+            blue_gains,
+            rgb2cam,
+            cam2rgb,
+            use_numba=self.use_numba)
 
     def transform(self, results):
         metadata = results['metadata']
@@ -68,9 +60,10 @@ class Img2LQ_Raws(BaseTransform):
 
         raws = []
         for i in range(len(results[self.key])):
-            raw = self.BGR2RGB(results[self.key][i])
+            # HxWxC BGR -> CxHxW RGB, materialized once in contiguous memory
+            # so that the whole unprocessing pipeline stays in CHW.
+            raw = self.BGR2RGB(results[self.key][i]).transpose(2, 0, 1)
             raw = torch.from_numpy(np.ascontiguousarray(raw))
-            raw = raw.permute(2, 0, 1)
             raw, _ = self.unprocess_meta_gt(raw, metadata['rgb_gain'],
                                             metadata['red_gain'],
                                             metadata['blue_gain'],
@@ -111,52 +104,34 @@ class Img2GT_Raws(BaseTransform):
         rgb_gain_ratio=1.0,
         red_gain_range=[1.5, 3],
         blue_gain_range=[1.5, 3.5])
+
+    Set ``use_numba=True`` to unprocess with the numba kernels, which are
+    faster but differ from the torch path by up to 2e-3.
     """
 
     def __init__(self,
                  key,
                  rgb_gain_ratio=1.0,
                  red_gain_range=[1.5, 3],
-                 blue_gain_range=[1.5, 3.5]):
+                 blue_gain_range=[1.5, 3.5],
+                 use_numba=False):
         self.key = key
         self.rgb_gain_ratio = rgb_gain_ratio
         self.red_gain_range = red_gain_range
         self.blue_gain_range = blue_gain_range
+        self.use_numba = use_numba
 
     def BGR2RGB(self, img_bgr):
         return img_bgr[..., ::-1]
 
     def unprocess_gt(self, image):
         """Unprocesses an image from sRGB to realistic raw data."""
-
-        # Randomly creates image metadata.
-        rgb2cam = random_ccm()
-        cam2rgb = torch.inverse(rgb2cam)
-        rgb_gain, red_gain, blue_gain = random_gains(self.rgb_gain_ratio,
-                                                     self.red_gain_range,
-                                                     self.blue_gain_range)
-
-        # Approximately inverts global tone mapping.
-        image = inverse_smoothstep(image)
-        # Inverts gamma compression.
-        image = gamma_expansion(image)
-        # Inverts color correction.
-        image = apply_ccm(image, rgb2cam)
-        # Approximately inverts white balance and brightening.
-        image = safe_invert_gains(image, rgb_gain, red_gain, blue_gain)
-        # Clips saturated pixels.
-        image = torch.clamp(image, min=0.0, max=1.0)
-        # Applies a Bayer mosaic.
-        # image = mosaic(image)
-
-        metadata = {
-            'cam2rgb': cam2rgb,
-            'rgb2cam': rgb2cam,
-            'rgb_gain': rgb_gain,
-            'red_gain': red_gain,
-            'blue_gain': blue_gain,
-        }
-        return image, metadata
+        return gcp_unprocess.unprocess_gt(
+            image,
+            self.rgb_gain_ratio,
+            self.red_gain_range,
+            self.blue_gain_range,
+            use_numba=self.use_numba)
 
     def transform(self, results):
         """transform function.
@@ -171,9 +146,10 @@ class Img2GT_Raws(BaseTransform):
 
         raws = []
         for i in range(len(results[self.key])):
-            raw = self.BGR2RGB(results[self.key][i])
+            # HxWxC BGR -> CxHxW RGB, materialized once in contiguous memory
+            # so that the whole unprocessing pipeline stays in CHW.
+            raw = self.BGR2RGB(results[self.key][i]).transpose(2, 0, 1)
             raw = torch.from_numpy(np.ascontiguousarray(raw))
-            raw = raw.permute(2, 0, 1)
             raw, metadata = self.unprocess_gt(raw)
             raws.append(raw)
 
@@ -1,172 +1,567 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import math
+import threading
+
 import numpy as np
 import torch
-import torch.distributions as tdist
-
-
-def random_ccm():
-    """Generates random RGB -> Camera color correction matrices."""
+import torch.nn.functional as F
+
+try:
+    from numba import config as numba_config
+    from numba import get_num_threads, njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+# Least-squares fit of 0.5 - sin(asin(1 - 2 * r**2) / 3) on
+# r in [0, sqrt(0.5)], highest order (r**7) first. Used by the numba kernel
+# in place of inverse_smoothstep (max abs error ~1.4e-6).
+_INV_SMOOTHSTEP_COEFFS = (0.3688559149, -0.6240563866, 0.5029610372,
+                          -0.1484715562, 0.08855940921, 0.10796785,
+                          0.5774443455)
+# Relative least-squares fit of m**2.2 on m in [0.5, 1], highest order
+# (m**5) first. Used by the numba kernel in place of gamma_expansion, with
+# x**2.2 = m**2.2 * 2**(2.2 * e) for x = m * 2**e (max relative error
+# ~1.7e-7).
+_GAMMA_MANTISSA_COEFFS = (0.01585767327, -0.08983486062, 0.2909817819,
+                          0.8277979735, -0.04847402761, 0.003671602492)
+# Exponent of 1e-8 (the gamma_expansion clamp) as returned by frexp.
+_GAMMA_MIN_EXPONENT = -26
+# 2**(2.2 * e) for the exponents e of inputs in [1e-8, 1].
+_GAMMA_EXPONENT_SCALES = tuple(2.0**(2.2 * e)
+                               for e in range(_GAMMA_MIN_EXPONENT, 2))
+# Gray level above which gains are masked towards 1 by safe_invert_gains.
+_SAFE_GAINS_INFLECTION = 0.9
+# Number of gray levels in [_SAFE_GAINS_INFLECTION, 1] tabulated by
+# _safe_gains_lut.
+_SAFE_GAINS_LUT_SIZE = 1024
+
+# XYZ -> Camera CCMs combined by random_ccm.
+_XYZ2CAMS = torch.tensor(
+    [[[1.0234, -0.2969, -0.2266], [-0.5625, 1.6328, -0.0469],
+      [-0.0703, 0.2188, 0.6406]],
+     [[0.4913, -0.0541, -0.0202], [-0.613, 1.3513, 0.2906],
+      [-0.1564, 0.2151, 0.7183]],
+     [[0.838, -0.263, -0.0639], [-0.2887, 1.0725, 0.2496],
+      [-0.0627, 0.1427, 0.5438]],
+     [[0.6596, -0.2079, -0.0562], [-0.4782, 1.3016, 0.1933],
+      [-0.097, 0.1581, 0.5181]]],
+    dtype=torch.float32)
+# sRGB -> XYZ (D65) matrix.
+_RGB2XYZ = torch.tensor([[0.4124564, 0.3575761, 0.1804375],
+                         [0.2126729, 0.7151522, 0.0721750],
+                         [0.0193339, 0.1191920, 0.9503041]],
+                        dtype=torch.float32)
+
+# Per-thread state reused across calls, e.g. by data loader threads.
+_local = threading.local()
+
+# TorchScript versions of the hot helpers, compiled on first use.
+_scripted_fns = {}
+
+
+def _scripted(fn):
+    """Returns ``fn`` compiled with TorchScript.
+
+    Compilation is deferred to the first call and cached, so importing the
+    datasets package never depends on TorchScript.
+    """
+    scripted = _scripted_fns.get(fn)
+    if scripted is None:
+        scripted = _scripted_fns[fn] = torch.jit.script(fn)
+    return scripted
+
+
+def random_ccm(batch_size=None, device=None):
+    """Generates random RGB -> Camera color correction matrices.
+
+    Args:
+        batch_size (int, optional): Number of matrices to sample. Defaults
+            to None, i.e. a single matrix.
+        device (torch.device, optional): Device to sample on. Defaults to
+            None, i.e. the CPU.
+
+    Returns:
+        Tensor: A (3, 3) matrix, or (batch_size, 3, 3) matrices.
+    """
     # Takes a random convex combination of XYZ -> Camera CCMs.
-    xyz2cams = [[[1.0234, -0.2969, -0.2266], [-0.5625, 1.6328, -0.0469],
-                 [-0.0703, 0.2188, 0.6406]],
-                [[0.4913, -0.0541, -0.0202], [-0.613, 1.3513, 0.2906],
-                 [-0.1564, 0.2151, 0.7183]],
-                [[0.838, -0.263, -0.0639], [-0.2887, 1.0725, 0.2496],
-                 [-0.0627, 0.1427, 0.5438]],
-                [[0.6596, -0.2079, -0.0562], [-0.4782, 1.3016, 0.1933],
-                 [-0.097, 0.1581, 0.5181]]]
-    num_ccms = len(xyz2cams)
-    xyz2cams = torch.FloatTensor(xyz2cams)
-    weights = torch.FloatTensor(num_ccms, 1, 1).uniform_(1e-8, 1e8)
-    weights_sum = torch.sum(weights, dim=0)
-    xyz2cam = torch.sum(xyz2cams * weights, dim=0) / weights_sum
+    num_ccms = _XYZ2CAMS.size(0)
+    shape = (num_ccms, ) if batch_size is None else (batch_size, num_ccms)
+    weights = torch.empty(shape, device=device).uniform_(1e-8, 1e8)
+    weights.div_(weights.sum(dim=-1, keepdim=True))
+    xyz2cam = torch.tensordot(
+        weights, _XYZ2CAMS.to(weights.device), dims=1)
 
     # Multiplies with RGB -> XYZ to get RGB -> Camera CCM.
-    rgb2xyz = torch.FloatTensor([[0.4124564, 0.3575761, 0.1804375],
-                                 [0.2126729, 0.7151522, 0.0721750],
-                                 [0.0193339, 0.1191920, 0.9503041]])
-    rgb2cam = torch.mm(xyz2cam, rgb2xyz)
+    rgb2cam = torch.matmul(xyz2cam, _RGB2XYZ.to(weights.device))
 
     # Normalizes each row.
-    rgb2cam = rgb2cam / torch.sum(rgb2cam, dim=-1, keepdim=True)
+    rgb2cam.div_(torch.sum(rgb2cam, dim=-1, keepdim=True))
     return rgb2cam
 
 
+def inverse_3x3(matrix):
+    """Inverts a 3x3 matrix via its adjugate.
+
+    Cheaper than ``torch.inverse`` for a single 3x3 matrix on CPU, which
+    goes through a full LAPACK factorization. Matrices on other devices are
+    passed to ``torch.inverse``, reading them back to the host would force a
+    sync.
+    """
+    if matrix.device.type != 'cpu':
+        return torch.inverse(matrix)
+    a, b, c, d, e, f, g, h, i = matrix.flatten().tolist()
+    det = a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+    if det == 0:
+        raise ValueError(f'Singular matrix cannot be inverted: {matrix}')
+    adjugate = [[e * i - f * h, c * h - b * i, b * f - c * e],
+                [f * g - d * i, a * i - c * g, c * d - a * f],
+                [d * h - e * g, b * g - a * h, a * e - b * d]]
+    return torch.tensor(
+        adjugate, dtype=matrix.dtype, device=matrix.device) / det
+
+
 def random_gains(rgb_gain_ratio=1.0,
                  red_gain_range=[1.9, 2.4],
-                 blue_gain_range=[1.5, 1.9]):
-    """Generates random gains for brightening and white balance."""
+                 blue_gain_range=[1.5, 1.9],
+                 batch_size=None,
+                 device=None):
+    """Generates random gains for brightening and white balance.
+
+    The gains have shape (1, ), or (batch_size, 1) if ``batch_size`` is
+    given, and are sampled on ``device``.
+    """
+    shape = (1, ) if batch_size is None else (batch_size, 1)
     # RGB gain represents brightening.
-    n = tdist.Normal(loc=torch.tensor([0.8]), scale=torch.tensor([0.1]))
-    rgb_gain = 1.0 / n.sample()
+    rgb_gain = torch.randn(
+        shape, device=device).mul_(0.1).add_(0.8).reciprocal_()
     rgb_gain = rgb_gain_ratio * rgb_gain
 
     # Red and blue gains represent white balance.
-    red_gain = torch.FloatTensor(1).uniform_(red_gain_range[0],
-                                             red_gain_range[1])
-    blue_gain = torch.FloatTensor(1).uniform_(blue_gain_range[0],
-                                              blue_gain_range[1])
+    red_gain = torch.empty(shape, device=device)
+    red_gain.uniform_(red_gain_range[0], red_gain_range[1])
+    blue_gain = torch.empty(shape, device=device)
+    blue_gain.uniform_(blue_gain_range[0], blue_gain_range[1])
     return rgb_gain, red_gain, blue_gain
 
 
 def inverse_smoothstep(image):
     """Approximately inverts a global tone mapping curve."""
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
     image = torch.clamp(image, min=0.0, max=1.0)
     out = 0.5 - torch.sin(torch.asin(1.0 - 2.0 * image) / 3.0)
-    out = out.permute(2, 0, 1)  # Re-Permute the tensor back to CxHxW format
     return out
 
 
 def gamma_expansion(image):
     """Converts from gamma to linear space."""
     # Clamps to prevent numerical instability of gradients near zero.
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
     out = torch.clamp(image, min=1e-8)**2.2
-    # Re-Permute the tensor back to CxHxW format
-    out = out.permute(2, 0, 1)
     return out
 
 
 def apply_ccm(image, ccm):
-    """Applies a color correction matrix."""
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
-    shape = image.size()
-    image = torch.reshape(image, [-1, 3])
-    image = torch.tensordot(image, ccm, dims=[[-1], [-1]])
-    out = torch.reshape(image, shape)
-    out = out.permute(2, 0, 1)  # Re-Permute the tensor back to CxHxW format
+    """Applies a color correction matrix.
+
+    ``ccm`` is cast to the dtype and device of ``image``. bfloat16 images
+    on CPU are corrected in float32, not every torch version has bfloat16
+    CPU convolutions.
+    """
+    dtype = image.dtype
+    if dtype == torch.bfloat16 and image.device.type == 'cpu':
+        image = image.float()
+    # A CCM on a CxHxW image is a 1x1 convolution with ccm as the weight.
+    out = F.conv2d(image.unsqueeze(0), ccm.to(image).reshape(3, 3, 1, 1))
+    return out.squeeze(0).to(dtype)
+
+
+def apply_ccm_batched(images, ccms):
+    """Applies per-image color correction matrices to a batch.
+
+    Args:
+        images (Tensor): Images of shape (N, 3, H, W).
+        ccms (Tensor): Color correction matrices of shape (N, 3, 3).
+
+    Returns:
+        Tensor: Corrected images of shape (N, 3, H, W), see
+        :func:`apply_ccm` for the handling of dtypes.
+    """
+    dtype = images.dtype
+    if dtype == torch.bfloat16 and images.device.type == 'cpu':
+        images = images.float()
+    # (N, 3, 3) x (N, 3, H*W) keeps NCHW contiguous, no permute needed.
+    num_images, channels, height, width = images.size()
+    out = torch.bmm(ccms.to(images),
+                    images.reshape(num_images, channels, height * width))
+    return out.reshape(num_images, channels, height, width).to(dtype)
+
+
+def _inverse_gains(rgb_gain, red_gain, blue_gain):
+    """Stacks the inverted white balance and brightening gains into a
+    (..., 3, 1, 1) tensor broadcastable over (..., 3, H, W) images.
+
+    Gains may be given as floats, as tensors of shape (1, ) or as batched
+    (N, 1) tensors.
+    """
+    rgb_gain, red_gain, blue_gain = (
+        torch.atleast_1d(torch.as_tensor(gain, dtype=torch.float32))
+        for gain in (rgb_gain, red_gain, blue_gain))
+    gains = torch.cat(
+        [1.0 / red_gain, torch.ones_like(red_gain), 1.0 / blue_gain],
+        dim=-1) / rgb_gain
+    return gains[..., None, None]
+
+
+def _safe_gains_lut(gains):
+    """Tabulates the masked gains of each channel near white.
+
+    Returns a (..., 3, _SAFE_GAINS_LUT_SIZE) tensor for (..., 3, 1, 1)
+    gains, whose columns evenly sample the safe gains for gray levels from
+    the inflection to 1. Below the inflection the gains are unmasked, i.e.
+    equal to the first column.
+    """
+    t = torch.linspace(
+        0.0,
+        1.0,
+        _SAFE_GAINS_LUT_SIZE,
+        dtype=gains.dtype,
+        device=gains.device)
+    gains = gains.flatten(-2)
+    # Prevents dimming of saturated pixels by smoothly masking gains near white
+    mask = t * t
+    return torch.max(mask + (1.0 - mask) * gains, gains)
+
+
+def _apply_safe_gains(image, gains):
+    """Applies (..., 3, 1, 1) gains, smoothly masking them near white.
+
+    The masked gains are looked up in ``_safe_gains_lut`` instead of being
+    computed per pixel. Below the inflection they are exact, above it the
+    nearest entry is off by at most ~1e-3 * |1 - gain|. The int64 index
+    used for the lookup is twice the size of the float32 gray plane, which
+    is still less than the per-pixel mask and gains it replaces.
+    """
+    # The table is built in the dtype of the gains, e.g. float32 for
+    # reduced precision images, and moved to the image once.
+    lut = _safe_gains_lut(gains).to(image)
+    # The lookup index is not differentiable, the gray plane needs no graph.
+    gray = torch.mean(image.detach(), dim=-3, dtype=torch.float32)
+    # Maps [inflection, 1] onto the table, darker pixels onto its first entry.
+    scale = (_SAFE_GAINS_LUT_SIZE - 1) / (1.0 - _SAFE_GAINS_INFLECTION)
+    index = gray.sub_(_SAFE_GAINS_INFLECTION).mul_(scale)
+    index = index.clamp_(0.0, _SAFE_GAINS_LUT_SIZE - 1.0).add_(0.5).long()
+    # Gathers the gains of all channels at the flattened pixel positions.
+    index = index.flatten(-2).unsqueeze(-2)
+    index = index.expand(lut.shape[:-1] + index.shape[-1:])
+    # gather returns a fresh tensor, multiply into it in place.
+    out = torch.gather(lut, -1, index).view_as(image).mul_(image)
     return out
 
 
 def safe_invert_gains(image, rgb_gain, red_gain, blue_gain):
     """Inverts gains while safely handling saturated pixels."""
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
-    gains = torch.stack(
-        (1.0 / red_gain, torch.tensor([1.0]), 1.0 / blue_gain)) / rgb_gain
-    gains = gains.squeeze()
-    gains = gains[None, None, :]
-    # Prevents dimming of saturated pixels by smoothly masking gains near white
-    gray = torch.mean(image, dim=-1, keepdim=True)
-    inflection = 0.9
-    mask = (torch.clamp(gray - inflection, min=0.0) / (1.0 - inflection))**2.0
-    safe_gains = torch.max(mask + (1.0 - mask) * gains, gains)
-    out = image * safe_gains
-    # Re-Permute the tensor back to CxHxW format
-    out = out.permute(2, 0, 1)
-    return out
+    gains = _inverse_gains(rgb_gain, red_gain, blue_gain)
+    return _apply_safe_gains(image, gains)
+
+
+def _linearize(image):
+    """Inverts tone mapping and gamma compression.
+
+    16-bit inputs are evaluated in float32 and cast back, as the curves
+    lose too much accuracy in half precision.
+    """
+    dtype = image.dtype
+    if dtype == torch.float16 or dtype == torch.bfloat16:
+        image = image.float()
+    image = inverse_smoothstep(image)
+    return gamma_expansion(image).to(dtype)
+
+
+def _unprocess_pointwise_torch(image, ccm, gains):
+    """Torch path of the pointwise part of the unprocessing pipeline.
+
+    Equivalent to ``inverse_smoothstep`` -> ``gamma_expansion`` ->
+    ``apply_ccm`` -> ``safe_invert_gains`` -> ``clamp`` on a CxHxW image,
+    with ``gains`` given as a (3, 1, 1) tensor. ``ccm`` and ``gains`` are
+    moved to the dtype and device of ``image`` where needed. It is called
+    through ``_scripted`` to save the Python dispatch between the stages,
+    which still make one pass over the image each. Only the numba kernels
+    visit each pixel once.
+    """
+    image = _linearize(image)
+    image = apply_ccm(image, ccm)
+    image = _apply_safe_gains(image, gains)
+    return image.clamp_(min=0.0, max=1.0)
 
 
 def mosaic(image):
-    """Extracts RGGB Bayer planes from an RGB image."""
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
-    shape = image.size()
-    red = image[0::2, 0::2, 0]
-    green_red = image[0::2, 1::2, 1]
-    green_blue = image[1::2, 0::2, 1]
-    blue = image[1::2, 1::2, 2]
-    out = torch.stack((red, green_red, green_blue, blue), dim=-1)
-    out = torch.reshape(out, (shape[0] // 2, shape[1] // 2, 4))
-    # Re-Permute the tensor back to CxHxW format
-    out = out.permute(2, 0, 1)
+    """Extracts RGGB Bayer planes from an RGB image.
+
+    Leading batch dimensions are supported, i.e. (..., 3, H, W) images are
+    mapped to (..., 4, H/2, W/2) Bayer planes.
+    """
+    height, width = image.shape[-2:]
+    # View the image as (..., C, dy, dx, H/2, W/2) phases of the 2x2 Bayer
+    # tile and gather the (channel, dy, dx) of R, Gr, Gb, B in one indexing.
+    planes = image.reshape(image.shape[:-2] + (height // 2, 2, width // 2, 2))
+    planes = planes.movedim((-4, -2), (-2, -1))
+    out = planes[..., [0, 1, 1, 2], [0, 0, 1, 1], [0, 1, 0, 1], :, :]
     return out
 
 
+if njit is not None:
+
+    _GAMMA_EXPONENT_SCALES_NP = np.array(
+        _GAMMA_EXPONENT_SCALES, dtype=np.float32)
+
+    @njit(inline='always', fastmath=True, cache=True, nogil=True)
+    def _linearize_pixel(value):
+        """Scalar ``inverse_smoothstep`` followed by ``gamma_expansion``.
+
+        The curves are evaluated with the ``_INV_SMOOTHSTEP_COEFFS`` and
+        ``_GAMMA_MANTISSA_COEFFS`` polynomials, which avoid three
+        transcendentals per pixel.
+        """
+        value = min(max(value, 0.0), 1.0)
+        r = math.sqrt(min(value, 1.0 - value))
+        out = 0.0
+        for coeff in _INV_SMOOTHSTEP_COEFFS:
+            out = (out + coeff) * r
+        if value > 0.5:
+            out = 1.0 - out
+        mantissa, exponent = math.frexp(max(out, 1e-8))
+        out = 0.0
+        for coeff in _GAMMA_MANTISSA_COEFFS:
+            out = out * mantissa + coeff
+        return out * _GAMMA_EXPONENT_SCALES_NP[exponent - _GAMMA_MIN_EXPONENT]
+
+    @njit(fastmath=True, cache=True, nogil=True)
+    def _unprocess_row(red, green, blue, ccm, gains_lut, out_red, out_green,
+                       out_blue):
+        """Runs the pointwise unprocessing chain over one row.
+
+        Inputs and outputs are separate contiguous R, G, B rows, so the CCM
+        reduces to three broadcast FMAs per output channel which LLVM can
+        vectorize, instead of strided loads from interleaved RGB pixels.
+        """
+        ccm00, ccm01, ccm02 = ccm[0, 0], ccm[0, 1], ccm[0, 2]
+        ccm10, ccm11, ccm12 = ccm[1, 0], ccm[1, 1], ccm[1, 2]
+        ccm20, ccm21, ccm22 = ccm[2, 0], ccm[2, 1], ccm[2, 2]
+        max_index = gains_lut.shape[1] - 1
+        scale = max_index / (1.0 - _SAFE_GAINS_INFLECTION)
+        for x in range(red.shape[0]):
+            r = _linearize_pixel(red[x])
+            g = _linearize_pixel(green[x])
+            b = _linearize_pixel(blue[x])
+            cam_red = ccm00 * r + ccm01 * g + ccm02 * b
+            cam_green = ccm10 * r + ccm11 * g + ccm12 * b
+            cam_blue = ccm20 * r + ccm21 * g + ccm22 * b
+            gray = (cam_red + cam_green + cam_blue) / 3.0
+            position = (gray - _SAFE_GAINS_INFLECTION) * scale
+            index = int(min(max(position, 0.0), max_index) + 0.5)
+            out_red[x] = min(max(cam_red * gains_lut[0, index], 0.0), 1.0)
+            out_green[x] = min(
+                max(cam_green * gains_lut[1, index], 0.0), 1.0)
+            out_blue[x] = min(max(cam_blue * gains_lut[2, index], 0.0), 1.0)
+
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _unprocess_planes(image, ccm, gains_lut):
+        """Pointwise unprocessing of a planar (3, H, W) float32 image.
+
+        Same arguments as ``_unprocess_core``, returns the unprocessed
+        (3, H, W) image without the Bayer mosaic.
+        """
+        out = np.empty_like(image)
+        for y in prange(image.shape[1]):
+            _unprocess_row(image[0, y], image[1, y], image[2, y], ccm,
+                           gains_lut, out[0, y], out[1, y], out[2, y])
+        return out
+
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _unprocess_core(image, ccm, gains_lut):
+        """Fused pointwise unprocessing and RGGB mosaic.
+
+        Args:
+            image (np.ndarray): Planar sRGB image of shape (3, H, W),
+                float32.
+            ccm (np.ndarray): RGB -> Camera matrix of shape (3, 3).
+            gains_lut (np.ndarray): Safe gains table of shape (3, N) as
+                built by ``_safe_gains_lut``.
+
+        Returns:
+            np.ndarray: Bayer planes of shape (4, H // 2, W // 2).
+        """
+        height = image.shape[1] // 2
+        width = image.shape[2] // 2
+        out = np.empty((4, height, width), dtype=np.float32)
+        # Splits the tile rows into one contiguous chunk per thread so the
+        # row buffer is allocated once per chunk rather than once per row.
+        num_chunks = min(get_num_threads(), height)
+        for chunk in prange(num_chunks):
+            # Unprocessed R, G, B planes of the two input rows of a tile
+            # row, indexed as (channel, dy, x).
+            rows = np.empty((3, 2, 2 * width), dtype=np.float32)
+            start = chunk * height // num_chunks
+            stop = (chunk + 1) * height // num_chunks
+            for i in range(start, stop):
+                for dy in range(2):
+                    # Rows are cut to the row buffer, numba does not check
+                    # bounds and would write past it for odd widths.
+                    y = 2 * i + dy
+                    _unprocess_row(image[0, y, :2 * width],
+                                   image[1, y, :2 * width],
+                                   image[2, y, :2 * width], ccm, gains_lut,
+                                   rows[0, dy], rows[1, dy], rows[2, dy])
+                for j in range(width):
+                    out[0, i, j] = rows[0, 0, 2 * j]
+                    out[1, i, j] = rows[1, 0, 2 * j + 1]
+                    out[2, i, j] = rows[1, 1, 2 * j]
+                    out[3, i, j] = rows[2, 1, 2 * j + 1]
+        return out
+
+else:
+    _unprocess_planes = _unprocess_core = None
+
+
+def _use_numba(image, use_numba):
+    """Whether the numba kernels unprocess ``image``.
+
+    They are opt-in and only handle float32 CPU tensors, i.e. the data
+    workers. Their tone and gamma curves are polynomial approximations
+    evaluated with fastmath and the safe gains lookup rounds differently,
+    so the output differs from the torch path by up to 2e-3.
+
+    The kernels are capped to as many threads as torch, which DataLoader
+    workers set to one, so that the workers do not oversubscribe the CPU.
+    """
+    if not use_numba:
+        return False
+    if _unprocess_core is None:
+        raise ImportError('Please install numba to use `use_numba=True`.')
+    if (image.dtype != torch.float32 or image.device.type != 'cpu'
+            or image.requires_grad):
+        return False
+    set_num_threads(
+        min(torch.get_num_threads(), numba_config.NUMBA_NUM_THREADS))
+    return True
+
+
+def _unprocess_pointwise(image, ccm, gains, use_numba=False):
+    """Inverts tone mapping, gamma compression, color correction, white
+    balance and brightening, then clips saturated pixels."""
+    if _use_numba(image, use_numba):
+        image = _unprocess_planes(image.contiguous().numpy(), ccm.numpy(),
+                                  _safe_gains_lut(gains).numpy())
+        return torch.from_numpy(image)
+    return _scripted(_unprocess_pointwise_torch)(image, ccm, gains)
+
+
+def _check_dtype(image):
+    """Rejects dtype and device pairs the pipeline has no kernels for."""
+    if image.dtype == torch.float16 and image.device.type == 'cpu':
+        raise ValueError('float16 unprocessing is only supported on GPU, '
+                         'use torch.bfloat16 on CPU.')
+
+
 def random_noise_levels_kpn():
-    sigma_read = torch.from_numpy(
-        np.power(10, np.random.uniform(-3.0, -1.5, (1, ))))
+    sigma_read = torch.pow(10.0, torch.empty(1).uniform_(-3.0, -1.5))
     # sigma_read = sigma_read**2
-    sigma_shot = torch.from_numpy(
-        np.power(10, np.random.uniform(-4.0, -2.0, (1, ))))
-
-    sigma_read = sigma_read.type(torch.FloatTensor)
-    sigma_shot = sigma_shot.type(torch.FloatTensor)
+    sigma_shot = torch.pow(10.0, torch.empty(1).uniform_(-4.0, -2.0))
 
     return sigma_shot, sigma_read
 
 
+def _scratch_like(name, tensor):
+    """Returns a per-thread scratch buffer matching ``tensor``.
+
+    A buffer is only cached under ``name`` once the same shape, dtype and
+    device are requested twice in a row, e.g. for fixed-size training crops.
+    Otherwise a temporary is returned and the previous buffer is released,
+    so variable-size inputs neither pin memory nor pay for the cache.
+    """
+    key = (tensor.shape, tensor.dtype, tensor.device)
+    cached_key, buffer = getattr(_local, name, (None, None))
+    if cached_key == key and buffer is not None:
+        return buffer
+    buffer = torch.empty(
+        tensor.shape, dtype=tensor.dtype, device=tensor.device)
+    setattr(_local, name, (key, buffer if cached_key == key else None))
+    return buffer
+
+
 def add_noise(image,
               shot_noise=0.01,
               read_noise=0.0005,
               read_noise_exponent=2):
     """Adds random shot (proportional to image) and read (independent)
     noise."""
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
-    variance = image * shot_noise + read_noise**read_noise_exponent
-    n = tdist.Normal(
-        loc=torch.zeros_like(variance), scale=torch.sqrt(variance))
-    noise = n.sample()
+    read_variance = read_noise**read_noise_exponent
+    if image.requires_grad:
+        # Autograd does not support out= arguments. Gradients only flow
+        # through the image, the sampled noise is a constant.
+        variance = image.detach() * shot_noise + read_variance
+        noise = torch.randn_like(variance).mul_(variance.sqrt_())
+        return image + noise
+    return _scripted(_add_noise)(image, torch.as_tensor(shot_noise),
+                                 torch.as_tensor(read_variance),
+                                 _scratch_like('variance', image),
+                                 _scratch_like('noise', image))
+
+
+def _add_noise(image, shot_noise, read_variance, variance, noise):
+    """TorchScript body of ``add_noise`` with the noise levels as tensors.
+
+    ``variance`` and ``noise`` are scratch buffers shaped like ``image``
+    which are overwritten.
+    """
+    torch.mul(image, shot_noise, out=variance).add_(read_variance)
+    torch.randn(image.shape, out=noise).mul_(variance.sqrt_())
     out = image + noise
-    out = out.permute(2, 0, 1)  # Re-Permute the tensor back to CxHxW format
     return out
 
 
-def unprocess(image):
-    """Unprocesses an image from sRGB to realistic raw data."""
+def unprocess(image, dtype=None, use_numba=False):
+    """Unprocesses an image from sRGB to realistic raw data.
+
+    Args:
+        image (Tensor): sRGB image of shape (3, H, W) in [0, 1].
+        dtype (torch.dtype, optional): Precision to run the pipeline in,
+            e.g. ``torch.bfloat16`` to halve the memory traffic. The tone
+            and gamma curves are evaluated in at least float32. float16 is
+            only supported on GPU. Defaults to the dtype of ``image``.
+        use_numba (bool): Whether to unprocess float32 CPU images with a
+            single-pass numba kernel. Its output differs from the torch
+            path by up to 2e-3, see ``_use_numba``. Default: False.
+
+    Returns:
+        tuple[Tensor, dict]: Bayer planes of shape (4, H/2, W/2) and the
+        sampled metadata.
+    """
+    height, width = image.shape[-2:]
+    if height % 2 or width % 2:
+        raise ValueError('The Bayer mosaic requires an even height and '
+                         f'width, got {height}x{width}.')
+    if dtype is not None:
+        image = image.to(dtype)
+    _check_dtype(image)
 
     # Randomly creates image metadata.
     rgb2cam = random_ccm()
-    cam2rgb = torch.inverse(rgb2cam)
+    cam2rgb = inverse_3x3(rgb2cam)
     rgb_gain, red_gain, blue_gain = random_gains()
 
-    # Approximately inverts global tone mapping.
-    image = inverse_smoothstep(image)
-    # Inverts gamma compression.
-    image = gamma_expansion(image)
-    # Inverts color correction.
-    image = apply_ccm(image, rgb2cam)
-    # Approximately inverts white balance and brightening.
-    image = safe_invert_gains(image, rgb_gain, red_gain, blue_gain)
-    # Clips saturated pixels.
-    image = torch.clamp(image, min=0.0, max=1.0)
-    # Applies a Bayer mosaic.
-    image = mosaic(image)
+    # Inverts tone mapping, gamma compression, color correction, white
+    # balance and brightening, then clips saturated pixels.
+    gains = _inverse_gains(rgb_gain, red_gain, blue_gain)
+    if _use_numba(image, use_numba):
+        # Runs the whole chain, Bayer mosaic included, in one numba kernel
+        # which releases the GIL and parallelizes over rows.
+        image = _unprocess_core(
+            image.contiguous().numpy(), rgb2cam.numpy(),
+            _safe_gains_lut(gains).numpy())
+        image = torch.from_numpy(image)
+    else:
+        image = _scripted(_unprocess_pointwise_torch)(image, rgb2cam, gains)
+        # Applies a Bayer mosaic.
+        image = mosaic(image)
 
     metadata = {
         'cam2rgb': cam2rgb,
@@ -178,24 +573,96 @@ def unprocess(image):
     return image, metadata
 
 
-def unprocess_gt(image):
-    """Unprocesses an image from sRGB to realistic raw data."""
+def unprocess_batched(images,
+                      rgb_gain_ratio=1.0,
+                      red_gain_range=[1.9, 2.4],
+                      blue_gain_range=[1.5, 1.9],
+                      dtype=None):
+    """Unprocesses a batch of sRGB images to realistic raw data.
+
+    Batched counterpart of :func:`unprocess`, meant to run on collated
+    batches (e.g. on GPU) rather than per image in the data workers. The
+    metadata of every image is sampled independently on ``images.device``.
+
+    Args:
+        images (Tensor): sRGB images of shape (N, 3, H, W) in [0, 1].
+        rgb_gain_ratio (float): Brightening gain ratio, see
+            :func:`random_gains`. Defaults to 1.0.
+        red_gain_range (list[float]): Range of the red gain. Defaults to
+            [1.9, 2.4].
+        blue_gain_range (list[float]): Range of the blue gain. Defaults to
+            [1.5, 1.9].
+        dtype (torch.dtype, optional): Precision to run the pipeline in,
+            see :func:`unprocess`. Defaults to the dtype of ``images``.
+
+    Returns:
+        tuple[Tensor, dict]: Bayer planes of shape (N, 4, H/2, W/2) and the
+        batched metadata, with (N, 3, 3) matrices and (N, 1) gains.
+    """
+    if dtype is not None:
+        images = images.to(dtype)
+    _check_dtype(images)
+    num_images = images.size(0)
+    device = images.device
 
     # Randomly creates image metadata.
-    rgb2cam = random_ccm()
+    rgb2cam = random_ccm(num_images, device)
     cam2rgb = torch.inverse(rgb2cam)
-    rgb_gain, red_gain, blue_gain = random_gains()
+    rgb_gain, red_gain, blue_gain = random_gains(rgb_gain_ratio,
+                                                 red_gain_range,
+                                                 blue_gain_range, num_images,
+                                                 device)
 
-    # Approximately inverts global tone mapping.
-    image = inverse_smoothstep(image)
-    # Inverts gamma compression.
-    image = gamma_expansion(image)
+    # Approximately inverts global tone mapping and gamma compression.
+    images = _linearize(images)
     # Inverts color correction.
-    image = apply_ccm(image, rgb2cam)
+    images = apply_ccm_batched(images, rgb2cam)
     # Approximately inverts white balance and brightening.
-    image = safe_invert_gains(image, rgb_gain, red_gain, blue_gain)
+    gains = _inverse_gains(rgb_gain, red_gain, blue_gain)
+    images = _apply_safe_gains(images, gains)
     # Clips saturated pixels.
-    image = torch.clamp(image, min=0.0, max=1.0)
+    images = images.clamp_(min=0.0, max=1.0)
+    # Applies a Bayer mosaic.
+    images = mosaic(images)
+
+    metadata = {
+        'cam2rgb': cam2rgb,
+        'rgb2cam': rgb2cam,
+        'rgb_gain': rgb_gain,
+        'red_gain': red_gain,
+        'blue_gain': blue_gain,
+    }
+    return images, metadata
+
+
+def unprocess_gt(image,
+                 rgb_gain_ratio=1.0,
+                 red_gain_range=[1.9, 2.4],
+                 blue_gain_range=[1.5, 1.9],
+                 dtype=None,
+                 use_numba=False):
+    """Unprocesses an image from sRGB to realistic raw data.
+
+    Same as :func:`unprocess` without the Bayer mosaic. The gain arguments
+    are forwarded to :func:`random_gains`. With ``use_numba=True`` float32
+    CPU images go through the numba kernel, whose output differs from the
+    torch path by up to 2e-3.
+    """
+    if dtype is not None:
+        image = image.to(dtype)
+    _check_dtype(image)
+
+    # Randomly creates image metadata.
+    rgb2cam = random_ccm()
+    cam2rgb = inverse_3x3(rgb2cam)
+    rgb_gain, red_gain, blue_gain = random_gains(rgb_gain_ratio,
+                                                 red_gain_range,
+                                                 blue_gain_range)
+
+    # Inverts tone mapping, gamma compression, color correction, white
+    # balance and brightening, then clips saturated pixels.
+    gains = _inverse_gains(rgb_gain, red_gain, blue_gain)
+    image = _unprocess_pointwise(image, rgb2cam, gains, use_numba)
     # Applies a Bayer mosaic.
     # image = mosaic(image)
 
@@ -209,20 +676,26 @@ def unprocess_gt(image):
     return image, metadata
 
 
-def unprocess_meta_gt(image, rgb_gains, red_gains, blue_gains, rgb2cam,
-                      cam2rgb):
-    """Unprocesses an image from sRGB to realistic raw data."""
-
-    # Approximately inverts global tone mapping.
-    image = inverse_smoothstep(image)
-    # Inverts gamma compression.
-    image = gamma_expansion(image)
-    # Inverts color correction.
-    image = apply_ccm(image, rgb2cam)
-    # Approximately inverts white balance and brightening.
-    image = safe_invert_gains(image, rgb_gains, red_gains, blue_gains)
-    # Clips saturated pixels.
-    image = torch.clamp(image, min=0.0, max=1.0)
+def unprocess_meta_gt(image,
+                      rgb_gains,
+                      red_gains,
+                      blue_gains,
+                      rgb2cam,
+                      cam2rgb,
+                      dtype=None,
+                      use_numba=False):
+    """Unprocesses an image from sRGB to realistic raw data.
+
+    Same as :func:`unprocess_gt` with given metadata.
+    """
+    if dtype is not None:
+        image = image.to(dtype)
+    _check_dtype(image)
+
+    # Inverts tone mapping, gamma compression, color correction, white
+    # balance and brightening, then clips saturated pixels.
+    gains = _inverse_gains(rgb_gains, red_gains, blue_gains)
+    image = _unprocess_pointwise(image, rgb2cam, gains, use_numba)
     # Applies a Bayer mosaic.
     # image = mosaic(image)
 
@@ -240,35 +713,35 @@ def random_noise_levels():
     """Generates random noise levels from a log-log linear distribution."""
     log_min_shot_noise = np.log(0.0001)
     log_max_shot_noise = np.log(0.012)
-    log_shot_noise = torch.FloatTensor(1).uniform_(log_min_shot_noise,
-                                                   log_max_shot_noise)
+    log_shot_noise = torch.empty(1).uniform_(log_min_shot_noise,
+                                             log_max_shot_noise)
     shot_noise = torch.exp(log_shot_noise)
 
     def line(x):
         return 2.18 * x + 1.20
 
-    n = tdist.Normal(loc=torch.tensor([0.0]), scale=torch.tensor([0.26]))
-    log_read_noise = line(log_shot_noise) + n.sample()
+    log_read_noise = line(log_shot_noise) + torch.randn(1) * 0.26
     read_noise = torch.exp(log_read_noise)
     return shot_noise, read_noise
 
 
+def _seeded_generator(seed):
+    """Returns the CPU generator of the calling thread, reseeded."""
+    generator = getattr(_local, 'generator', None)
+    if generator is None:
+        generator = _local.generator = torch.Generator()
+    generator.manual_seed(seed)
+    return generator
+
+
 def add_noise_test(image, shot_noise=0.01, read_noise=0.0005, count=0):
     """Adds random shot (proportional to image) and read (independent)
     noise."""
-    # Permute the image tensor to HxWxC format from CxHxW format
-    image = image.permute(1, 2, 0)
     variance = image * shot_noise + read_noise**2
-    # n = tdist.Normal(
-    #     loc=torch.zeros_like(variance), scale=torch.sqrt(variance))
-    # noise  = n.sample()
-    seed = torch.Generator()
-    seed.manual_seed(count)
-    noise = torch.normal(
-        mean=torch.zeros_like(variance),
-        std=torch.sqrt(variance),
-        generator=seed)
-    out = image + noise
-    # Re-Permute the tensor back to CxHxW format
-    out = out.permute(2, 0, 1)
+    # Draws the same stream as torch.normal(0, std) for a given count.
+    generator = _seeded_generator(count)
+    noise = torch.randn(
+        variance.shape, generator=generator, dtype=variance.dtype)
+    noise.mul_(variance.sqrt_())
+    out = noise.add_(image)
     return out
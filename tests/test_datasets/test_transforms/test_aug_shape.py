@@ -7,6 +7,7 @@ import pytest
 from mmagic.datasets.transforms import (CenterCropLongEdge, Flip, NumpyPad,
                                         RandomCropLongEdge, RandomRotation,
                                         RandomTransposeHW, Resize)
+from mmagic.datasets.transforms.aug_shape import Img2GT_Raws, Img2LQ_Raws
 
 
 class TestAugmentations:
@@ -371,6 +372,29 @@ def test_numpy_pad():
     assert str(pad) == repr_str
 
 
+def test_img2gt_raws():
+    gts = [np.random.rand(16, 24, 3).astype(np.float32) for _ in range(2)]
+    transform = Img2GT_Raws(key='gt', red_gain_range=[1.5, 3])
+    results = transform(dict(gt=gts))
+    assert results['gt'].shape == (2, 3, 16, 24)
+    assert results['gt'].min() >= 0 and results['gt'].max() <= 1
+    metadata = results['metadata']
+    assert metadata['rgb2cam'].shape == (3, 3)
+    assert metadata['cam2rgb'].shape == (3, 3)
+    assert 1.5 <= metadata['red_gain'].item() <= 3
+
+
+def test_img2lq_raws():
+    imgs = [np.random.rand(16, 24, 3).astype(np.float32) for _ in range(2)]
+    metadata = Img2GT_Raws(key='gt')(dict(gt=copy.deepcopy(imgs)))['metadata']
+    transform = Img2LQ_Raws(key='img')
+    results = transform(dict(img=imgs, metadata=metadata))
+    assert results['img'].shape == (2, 4, 8, 12)
+    assert results['img'].min() >= -64 / 1023.
+    assert results['img'].max() <= 1
+    assert results['noise_map'].shape == (2, 4, 8, 12)
+
+
 def teardown_module():
     import gc
     gc.collect()
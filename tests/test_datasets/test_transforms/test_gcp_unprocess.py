@@ -0,0 +1,264 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import pytest
+import torch
+
+from mmagic.datasets.transforms import gcp_unprocess
+
+
+def test_scripted_unprocess_pointwise():
+    image = torch.rand(3, 8, 12)
+    ccm = gcp_unprocess.random_ccm()
+    gains = gcp_unprocess._inverse_gains(*gcp_unprocess.random_gains())
+
+    pointwise = gcp_unprocess._unprocess_pointwise_torch
+    scripted = gcp_unprocess._scripted(pointwise)
+    assert isinstance(scripted, torch.jit.ScriptFunction)
+    assert gcp_unprocess._scripted(pointwise) is scripted
+    out = scripted(image, ccm, gains)
+    expected = pointwise(image, ccm, gains)
+    assert out.shape == (3, 8, 12)
+    assert torch.allclose(out, expected, atol=1e-6)
+
+
+def test_inverse_3x3():
+    for matrix in (gcp_unprocess.random_ccm(), torch.rand(3, 3) + torch.eye(3),
+                   torch.rand(3, 3, dtype=torch.float64) + torch.eye(3)):
+        out = gcp_unprocess.inverse_3x3(matrix)
+        assert out.dtype == matrix.dtype
+        assert torch.allclose(out, torch.inverse(matrix), atol=1e-5)
+
+    with pytest.raises(ValueError):
+        gcp_unprocess.inverse_3x3(torch.ones(3, 3))
+
+
+def test_inverse_smoothstep():
+    image = torch.linspace(0, 1, 10001, dtype=torch.float64)
+    out = gcp_unprocess.inverse_smoothstep(image.reshape(1, 1, -1))
+    expected = 0.5 - torch.sin(torch.asin(1.0 - 2.0 * image) / 3.0)
+    assert out.shape == (1, 1, 10001)
+    assert torch.allclose(out.flatten(), expected)
+
+    # The curve is differentiable inside (0, 1).
+    image = image[1:-1].clone().requires_grad_()
+    gcp_unprocess.inverse_smoothstep(image).sum().backward()
+    assert torch.isfinite(image.grad).all()
+
+
+def test_gamma_expansion():
+    image = torch.cat([torch.linspace(0, 1, 10001), torch.rand(100) * 4 + 1])
+    out = gcp_unprocess.gamma_expansion(image.reshape(1, 1, -1))
+    assert out.shape == (1, 1, 10101)
+    assert torch.allclose(out.flatten(), torch.clamp(image, min=1e-8)**2.2)
+
+    image.requires_grad_()
+    gcp_unprocess.gamma_expansion(image).sum().backward()
+    assert torch.isfinite(image.grad).all()
+
+
+def test_safe_gains_lut():
+    # Mostly bright pixels, so that the mask is exercised near white.
+    image = torch.rand(3, 64, 64).mul_(0.3).add_(0.7)
+    gains = torch.tensor([0.4, 0.8, 1.3]).reshape(3, 1, 1)
+    out = gcp_unprocess._apply_safe_gains(image, gains)
+
+    gray = torch.mean(image, dim=0, keepdim=True)
+    mask = (torch.clamp(gray - 0.9, min=0.0) / 0.1)**2
+    expected = image * torch.max(mask + (1.0 - mask) * gains, gains)
+    assert torch.allclose(out, expected, rtol=0, atol=1e-3)
+    # Below the inflection the gains are applied exactly.
+    dark = (gray < 0.9).expand_as(image)
+    assert torch.allclose(out[dark], expected[dark], rtol=0, atol=1e-6)
+
+
+def test_safe_invert_gains():
+    image = torch.rand(3, 8, 12)
+    out = gcp_unprocess.safe_invert_gains(image, 1.0, 2.0, 1.5)
+    expected = gcp_unprocess.safe_invert_gains(image, torch.tensor([1.0]),
+                                               torch.tensor([2.0]),
+                                               torch.tensor([1.5]))
+    assert torch.equal(out, expected)
+
+
+def test_numba_unprocess():
+    pytest.importorskip('numba')
+    image = torch.rand(3, 32, 48)
+    ccm = gcp_unprocess.random_ccm()
+    gains = gcp_unprocess._inverse_gains(*gcp_unprocess.random_gains())
+    gains_lut = gcp_unprocess._safe_gains_lut(gains).numpy()
+    expected = gcp_unprocess._scripted(
+        gcp_unprocess._unprocess_pointwise_torch)(image, ccm, gains)
+
+    # The numba and torch paths only differ where rounding moves the gray
+    # level of a pixel to the neighbouring entry of the safe gains table.
+    out = gcp_unprocess._unprocess_planes(image.numpy(), ccm.numpy(),
+                                          gains_lut)
+    out = torch.from_numpy(out)
+    assert out.shape == (3, 32, 48)
+    assert torch.allclose(out, expected, rtol=0, atol=2e-3)
+    assert (out - expected).abs().mean() < 1e-5
+
+    # Heights which do not split evenly over the threads of the kernel.
+    for height in (2, 14, 32):
+        image_rows = image[:, :height].contiguous()
+        out = gcp_unprocess._unprocess_core(image_rows.numpy(), ccm.numpy(),
+                                            gains_lut)
+        out = torch.from_numpy(out)
+        assert out.shape == (4, height // 2, 24)
+        assert torch.allclose(
+            out,
+            gcp_unprocess.mosaic(expected[:, :height]),
+            rtol=0,
+            atol=2e-3)
+
+    # Odd sizes drop the last row and column instead of writing past the
+    # row buffer.
+    image_odd = image[:, :15, :47].contiguous()
+    out = gcp_unprocess._unprocess_core(image_odd.numpy(), ccm.numpy(),
+                                        gains_lut)
+    out = torch.from_numpy(out)
+    assert out.shape == (4, 7, 23)
+    assert torch.allclose(
+        out, gcp_unprocess.mosaic(expected[:, :14, :46]), rtol=0, atol=2e-3)
+
+
+def test_unprocess_use_numba():
+    numba = pytest.importorskip('numba')
+    image = torch.rand(3, 8, 12)
+    num_threads = torch.get_num_threads()
+    try:
+        # DataLoader workers run torch with a single thread.
+        torch.set_num_threads(1)
+        torch.manual_seed(0)
+        out, _ = gcp_unprocess.unprocess(image, use_numba=True)
+        assert numba.get_num_threads() == 1
+        torch.manual_seed(0)
+        out_gt, _ = gcp_unprocess.unprocess_gt(image, use_numba=True)
+        assert numba.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(num_threads)
+
+    # The torch path stays the default.
+    torch.manual_seed(0)
+    expected, _ = gcp_unprocess.unprocess(image)
+    assert torch.allclose(out, expected, rtol=0, atol=2e-3)
+    torch.manual_seed(0)
+    expected, _ = gcp_unprocess.unprocess_gt(image)
+    assert torch.allclose(out_gt, expected, rtol=0, atol=2e-3)
+
+
+def test_add_noise():
+    image = torch.rand(4, 8, 12)
+    # Buffers are cached from the second call with the same shape on.
+    outs = [gcp_unprocess.add_noise(image) for _ in range(3)]
+    copies = [out.clone() for out in outs]
+    gcp_unprocess.add_noise(image)
+    for out, copy in zip(outs, copies):
+        assert torch.equal(out, copy)
+        for name in ('variance', 'noise'):
+            buffer = getattr(gcp_unprocess._local, name)[1]
+            assert out.data_ptr() != buffer.data_ptr()
+
+    image.requires_grad_()
+    out = gcp_unprocess.add_noise(image)
+    out.sum().backward()
+    assert torch.equal(image.grad, torch.ones_like(image))
+
+
+def test_add_noise_test():
+    image = torch.rand(4, 8, 12)
+    out = gcp_unprocess.add_noise_test(image, 0.01, 0.0005, count=7)
+
+    # Previous implementation, seeded with a fresh generator per call.
+    variance = image * 0.01 + 0.0005**2
+    noise = torch.normal(
+        mean=torch.zeros_like(variance),
+        std=torch.sqrt(variance),
+        generator=torch.Generator().manual_seed(7))
+    assert torch.allclose(out, image + noise)
+
+    # The cached generator is reseeded on every call.
+    assert torch.equal(
+        gcp_unprocess.add_noise_test(image, 0.01, 0.0005, count=7), out)
+
+
+def test_unprocess():
+    image, metadata = gcp_unprocess.unprocess(torch.rand(3, 8, 12))
+    assert image.shape == (4, 4, 6)
+    assert image.min() >= 0 and image.max() <= 1
+    assert metadata['rgb2cam'].shape == (3, 3)
+
+    image = gcp_unprocess.add_noise(image)
+    assert image.shape == (4, 4, 6)
+
+    with pytest.raises(ValueError):
+        gcp_unprocess.unprocess(torch.rand(3, 8, 11))
+
+
+@pytest.mark.parametrize('dtype', [torch.bfloat16, torch.float16])
+def test_unprocess_dtype(dtype):
+    image = torch.rand(3, 8, 12)
+    if dtype == torch.float16:
+        with pytest.raises(ValueError):
+            gcp_unprocess.unprocess(image, dtype=dtype)
+        if not torch.cuda.is_available():
+            pytest.skip('float16 unprocessing needs a GPU')
+        image = image.cuda()
+
+    torch.manual_seed(0)
+    expected, _ = gcp_unprocess.unprocess(image)
+    torch.manual_seed(0)
+    out, _ = gcp_unprocess.unprocess(image, dtype=dtype)
+    assert out.dtype == dtype
+    assert torch.allclose(out.float(), expected, rtol=0, atol=2e-2)
+
+    torch.manual_seed(0)
+    expected, metadata = gcp_unprocess.unprocess_gt(image)
+    out, _ = gcp_unprocess.unprocess_meta_gt(
+        image,
+        metadata['rgb_gain'],
+        metadata['red_gain'],
+        metadata['blue_gain'],
+        metadata['rgb2cam'],
+        metadata['cam2rgb'],
+        dtype=dtype)
+    assert out.dtype == dtype
+    assert torch.allclose(out.float(), expected, rtol=0, atol=2e-2)
+
+
+def test_unprocess_requires_grad():
+    image = torch.rand(3, 8, 12).mul_(0.8).add_(0.1).requires_grad_()
+    out, _ = gcp_unprocess.unprocess_gt(image)
+    out.sum().backward()
+    assert torch.isfinite(image.grad).all()
+
+
+def test_unprocess_batched():
+    images = torch.rand(2, 3, 8, 12)
+    out, metadata = gcp_unprocess.unprocess_batched(
+        images, red_gain_range=[1.5, 3], blue_gain_range=[1.5, 3.5])
+    assert out.shape == (2, 4, 4, 6)
+    assert out.min() >= 0 and out.max() <= 1
+    assert metadata['rgb2cam'].shape == (2, 3, 3)
+    assert metadata['cam2rgb'].shape == (2, 3, 3)
+    red_gain = metadata['red_gain']
+    assert red_gain.shape == (2, 1)
+    assert ((red_gain >= 1.5) & (red_gain <= 3)).all()
+
+    # Matches the per-image torch path given the same metadata.
+    for i in range(2):
+        gains = gcp_unprocess._inverse_gains(metadata['rgb_gain'][i],
+                                             red_gain[i],
+                                             metadata['blue_gain'][i])
+        expected = gcp_unprocess._scripted(
+            gcp_unprocess._unprocess_pointwise_torch)(images[i],
+                                                      metadata['rgb2cam'][i],
+                                                      gains)
+        expected = gcp_unprocess.mosaic(expected)
+        assert torch.allclose(out[i], expected, rtol=0, atol=2e-3)
+
+
+def teardown_module():
+    import gc
+    gc.collect()
+    globals().clear()
+    locals().clear()